@@ -2,12 +2,19 @@ import openai
 import logging
 import os
 import git
-import requests
+import httpx
+import orjson
+import asyncio
 import sys
 from datetime import datetime
 import shutil
+import base64
+import hashlib
+import re
+import numpy as np
+import sqlite3
 import time
-from requests.auth import HTTPBasicAuth
+from collections import OrderedDict
 
 # Read the OpenAI API key and GitHub token from environment variables
 openai.api_key = os.getenv('OPENAI_API_KEY')
@@ -15,146 +22,516 @@ github_token = os.getenv('GITHUB_TOKEN')
 sn_username = os.getenv('SN_USERNAME')
 sn_password = os.getenv('SN_PASSWORD')
 
+# State ID for "Awaiting User Info". You need to replace this with the actual value.
+AWAITING_USER_INFO_STATE_ID = 'your_awaiting_user_info_state_id'
+# State ID set while an incident is being worked on. You need to replace this with the actual value.
+IN_PROGRESS_STATE_ID = 'your_in_progress_state_id'
+
 # ServiceNow instance URL and endpoint for the incidents table
-SN_URL = "https://ansible.service-now.com/api/now/table/incident"
+SN_URL_BASE = "https://ansible.service-now.com"
+SN_URL = "/api/now/table/incident"
 SN_PARAMS = {
-    'sysparm_query': 'caller_id.name=Roger Lopez^ORDERBYDESCsys_created_on',
-    'sysparm_limit': 1
+    'sysparm_query': f'caller_id.name=Roger Lopez^state!={AWAITING_USER_INFO_STATE_ID}^ORDERBYDESCsys_created_on',
+    'sysparm_limit': 50,
+    # Only return the fields used here, without reference links, to keep the payload small
+    'sysparm_fields': 'sys_id,description,state,caller_id',
+    'sysparm_exclude_reference_link': 'true'
 }
 SN_HEADERS = {
     'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, br',
     'Content-Type': 'application/json'
 }
 
-# State ID for "Awaiting User Info". You need to replace this with the actual value.
-AWAITING_USER_INFO_STATE_ID = 'your_awaiting_user_info_state_id'
+# Incidents handled at the same time, and how many handled sys_ids to remember
+MAX_CONCURRENT_INCIDENTS = 8
+PROCESSED_INCIDENTS_SIZE = 1000
+
+# Adaptive poll interval bounds, in seconds
+POLL_INTERVAL_START = 1.0
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 30
+
+# Backoff before retrying a failed incident, in seconds, doubling per consecutive failure
+INCIDENT_RETRY_MIN = 30
+INCIDENT_RETRY_MAX = 3600
 
 # GitHub repository URL for existing playbooks
 EXISTING_PLAYBOOKS_REPO_URL = "https://github.com/cooktheryan/existing-playbooks.git"
 EXISTING_PLAYBOOKS_DIR = "existing_playbooks"
+EXISTING_PLAYBOOKS_BRANCH = "main"
+EXISTING_PLAYBOOKS_COMMIT_URL = f"/repos/cooktheryan/existing-playbooks/commits/{EXISTING_PLAYBOOKS_BRANCH}"
+
+# Maximum number of playbook evaluations sent to OpenAI at the same time
+MAX_CONCURRENT_EVALUATIONS = 8
+evaluation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_EVALUATIONS)
+incident_semaphore = asyncio.Semaphore(MAX_CONCURRENT_INCIDENTS)
+# Markdown code block markers around generated playbooks
+CODE_FENCE_RE = re.compile(r'```(?:yaml)?\n?')
+# Verdict keywords looked for in streamed evaluations, matched without lowercasing a copy.
+# A streamed evaluation that opens with a plain "no" will not say "matches" later.
+MATCHES_RE = re.compile(r'matches', re.IGNORECASE)
+# The lookahead needs an actual following character, since the buffer may end mid-word ("No" -> "Nothing").
+NEGATIVE_VERDICT_RE = re.compile(r'\s*no(?=\W)', re.IGNORECASE)
+
+# Playbook cache: exact matches on the description hash, then semantic matches on embeddings
+PLAYBOOK_CACHE_DB = "playbook_cache.db"
+PLAYBOOK_CACHE_TTL = 7 * 24 * 60 * 60
+PLAYBOOK_CACHE_SIZE = 256
+SEMANTIC_CACHE_THRESHOLD = 0.92
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Minimum cosine similarity for an existing playbook to match without asking GPT
+EXISTING_PLAYBOOK_MATCH_THRESHOLD = 0.85
+# Playbooks embedded per request, and characters kept per playbook to stay under the token limit
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_MAX_CHARS = 20000
+
+# System prompts are fixed, verbatim constants and always sent first so every call shares
+# the same prefix and benefits from OpenAI's automatic prompt caching
+SYSTEM_MSG_GEN = {
+    "role": "system",
+    "content": "You are an expert in writing Ansible playbooks. Reply with only a working playbook, without any explanation of it or how to run it."
+}
+SYSTEM_MSG_EVAL = {
+    "role": "system",
+    "content": "You are an expert in Ansible playbooks. Reply \"matches\" if the playbook resolves the incident description, otherwise reply \"no\"."
+}
 
 # Set up logging to stdout
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger()
 
-def get_most_recent_incident():
+# Persistent HTTP/2 clients so ServiceNow and GitHub calls reuse warm connections
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_HEADERS = {
+    'Accept': 'application/vnd.github.v3+json',
+    'Accept-Encoding': 'gzip, br',
+    'Content-Type': 'application/json'
+}
+if github_token:
+    GITHUB_HEADERS['Authorization'] = f'token {github_token}'
+SN_AUTH = httpx.BasicAuth(sn_username or '', sn_password or '')
+sn_client = httpx.AsyncClient(base_url=SN_URL_BASE, auth=SN_AUTH, headers=SN_HEADERS, http2=True, timeout=10)
+gh_client = httpx.AsyncClient(base_url=GITHUB_API_URL, headers=GITHUB_HEADERS, http2=True, timeout=10)
+
+# Persistent cache store, fronted by an in-memory LRU for exact matches
+cache_db = sqlite3.connect(PLAYBOOK_CACHE_DB)
+cache_db.execute(
+    "CREATE TABLE IF NOT EXISTS playbook_cache ("
+    "kind TEXT, namespace TEXT, key TEXT, embedding BLOB, playbook TEXT, created_at REAL, "
+    "PRIMARY KEY (kind, namespace, key))"
+)
+cache_db.commit()
+exact_cache = OrderedDict()
+# Recently handled incident sys_ids, oldest first
+processed_incidents = OrderedDict()
+# Incident sys_ids currently being handled, and the tasks handling them
+in_flight_incidents = set()
+incident_tasks = set()
+# Failed incident sys_ids, as (consecutive failures, earliest retry time)
+failed_incidents = {}
+
+def description_key(description):
+    return hashlib.sha256(description.encode()).hexdigest()
+
+async def embed_description(description):
+    response = await openai.Embedding.acreate(model=EMBEDDING_MODEL, input=description)
+    return response['data'][0]['embedding']
+
+def remember_exact(cache_key, playbook, created_at):
+    exact_cache[cache_key] = (created_at, playbook)
+    exact_cache.move_to_end(cache_key)
+    if len(exact_cache) > PLAYBOOK_CACHE_SIZE:
+        exact_cache.popitem(last=False)
+
+async def get_cached_playbook(kind, namespace, description, embedding=None):
+    """Return (playbook, embedding); the description is embedded only when the exact lookup misses."""
+    key = description_key(description)
+    cutoff = time.time() - PLAYBOOK_CACHE_TTL
+
+    cache_key = (kind, namespace, key)
+    if cache_key in exact_cache:
+        created_at, playbook = exact_cache[cache_key]
+        if created_at >= cutoff:
+            exact_cache.move_to_end(cache_key)
+            logger.info("Exact playbook cache hit.")
+            return playbook, embedding
+        del exact_cache[cache_key]
+
+    row = cache_db.execute(
+        "SELECT playbook, created_at FROM playbook_cache WHERE kind = ? AND namespace = ? AND key = ? AND created_at >= ?",
+        (kind, namespace, key, cutoff)
+    ).fetchone()
+    if row:
+        # Keep the stored timestamp so the entry expires from memory when it does in sqlite
+        remember_exact(cache_key, row[0], row[1])
+        logger.info("Exact playbook cache hit.")
+        return row[0], embedding
+
+    if embedding is None:
+        embedding = await embed_description(description)
+    rows = cache_db.execute(
+        "SELECT embedding, playbook FROM playbook_cache WHERE kind = ? AND namespace = ? AND created_at >= ?",
+        (kind, namespace, cutoff)
+    ).fetchall()
+    if not rows:
+        return None, embedding
+    matrix = np.stack([np.frombuffer(cached_embedding, dtype=np.float32) for cached_embedding, _ in rows])
+    query = np.asarray(embedding, dtype=np.float32)
+    scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+    best = int(np.argmax(scores))
+    if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+        logger.info(f"Semantic playbook cache hit with similarity {scores[best]:.3f}.")
+        return rows[best][1], embedding
+    return None, embedding
+
+def store_cached_playbook(kind, namespace, description, embedding, playbook):
+    key = description_key(description)
+    created_at = time.time()
+    # Expired entries are purged here rather than on every lookup; lookups skip them by created_at
+    cache_db.execute("DELETE FROM playbook_cache WHERE created_at < ?", (time.time() - PLAYBOOK_CACHE_TTL,))
+    cache_db.execute(
+        "INSERT OR REPLACE INTO playbook_cache VALUES (?, ?, ?, ?, ?, ?)",
+        (kind, namespace, key, np.asarray(embedding, dtype=np.float32).tobytes(), playbook, created_at)
+    )
+    cache_db.commit()
+    remember_exact((kind, namespace, key), playbook, created_at)
+
+def clear_cached_playbooks(kind):
+    cache_db.execute("DELETE FROM playbook_cache WHERE kind = ?", (kind,))
+    cache_db.commit()
+    for cache_key in [cache_key for cache_key in exact_cache if cache_key[0] == kind]:
+        del exact_cache[cache_key]
+
+def record_incident_failure(incident_sys_id):
+    failures = failed_incidents.get(incident_sys_id, (0, 0))[0] + 1
+    delay = min(INCIDENT_RETRY_MAX, INCIDENT_RETRY_MIN * 2 ** (failures - 1))
+    failed_incidents[incident_sys_id] = (failures, time.time() + delay)
+    logger.info(f"Retrying incident {incident_sys_id} in {delay}s after {failures} failure(s).")
+
+def mark_incident_processed(incident_sys_id):
+    failed_incidents.pop(incident_sys_id, None)
+    processed_incidents[incident_sys_id] = None
+    processed_incidents.move_to_end(incident_sys_id)
+    if len(processed_incidents) > PROCESSED_INCIDENTS_SIZE:
+        processed_incidents.popitem(last=False)
+
+async def get_recent_incidents():
     logger.info("Making a call to ServiceNow to check for incidents created by Roger Lopez.")
     try:
-        response = requests.get(SN_URL, params=SN_PARAMS, headers=SN_HEADERS, auth=HTTPBasicAuth(sn_username, sn_password))
+        response = await sn_client.get(SN_URL, params=SN_PARAMS)
         logger.info(f"ServiceNow response status code: {response.status_code}")
         response.raise_for_status()
 
-        incidents = response.json().get('result', [])
+        incidents = orjson.loads(response.content).get('result', [])
         logger.info(f"ServiceNow response: {incidents}")
 
-        return incidents[0] if incidents else None
-    except requests.exceptions.HTTPError as http_err:
+        return incidents
+    except httpx.HTTPStatusError as http_err:
         logger.error(f"HTTP error occurred: {http_err}")
     except Exception as err:
         logger.error(f"Other error occurred: {err}")
+    return []
+
+async def ask_openai(description, namespace='', embedding=None):
+    cached_playbook, embedding = await get_cached_playbook('generated', namespace, description, embedding)
+    if cached_playbook:
+        return cached_playbook
 
-def ask_openai(description):
     logger.info(f"Generating Ansible playbook for description: {description}")
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model="gpt-3.5-turbo",
         messages=[
-            {"role": "system", "content": "You are an expert in writing Ansible playbooks. You do not need any help in explaining the playbook or how to run the playbook. You return amazing playbooks that always work."},
+            SYSTEM_MSG_GEN,
             {"role": "user", "content": f"Create an Ansible playbook based on this incident description: {description}"}
         ]
     )
     playbook_content = response['choices'][0]['message']['content'].strip()
     logger.info(f"Generated playbook content: {playbook_content}")
+    store_cached_playbook('generated', namespace, description, embedding, playbook_content)
     return playbook_content
 
 def format_playbook_content(content):
     # Add YAML document marker '---' at the beginning and remove markdown code block markers
-    content = '---\n' + content.replace('```yaml', '').replace('```', '').strip()
-    return content
+    return '---\n' + CODE_FENCE_RE.sub('', content).strip()
+
+# Last commit SHA and ETag seen for the existing playbooks branch
+existing_playbooks_sha = None
+existing_playbooks_etag = None
+# Playbook contents keyed by path, as (mtime, content)
+playbook_cache = {}
+# Playbook embeddings keyed by path, stacked into a row-normalised matrix for matching
+playbook_embeddings = {}
+playbook_matrix_paths = []
+playbook_matrix_contents = []
+playbook_matrix = np.empty((0, 0))
 
 def clone_existing_playbooks_repo():
-    if os.path.isdir(EXISTING_PLAYBOOKS_DIR):
-        shutil.rmtree(EXISTING_PLAYBOOKS_DIR)
-    git.Repo.clone_from(EXISTING_PLAYBOOKS_REPO_URL, EXISTING_PLAYBOOKS_DIR)
-
-def search_existing_playbooks(description):
-    clone_existing_playbooks_repo()
-    logger.info("Searching for existing playbooks.")
-    existing_playbooks = []
-    for root, _, files in os.walk(EXISTING_PLAYBOOKS_DIR):
-        for file in files:
-            if file.endswith(".yml") or file.endswith(".yaml"):
-                with open(os.path.join(root, file), 'r') as f:
-                    playbook_content = f.read()
-                    existing_playbooks.append(playbook_content)
-
-    for playbook in existing_playbooks:
-        response = openai.ChatCompletion.create(
+    """Clone or fast-forward the playbooks checkout; return changed paths, or None if everything is new."""
+    # Shallow clone once, then only fetch the tip of the branch on later refreshes
+    if not os.path.isdir(os.path.join(EXISTING_PLAYBOOKS_DIR, '.git')):
+        if os.path.isdir(EXISTING_PLAYBOOKS_DIR):
+            shutil.rmtree(EXISTING_PLAYBOOKS_DIR)
+        logger.info(f"Cloning existing playbooks from {EXISTING_PLAYBOOKS_REPO_URL}")
+        git.Repo.clone_from(EXISTING_PLAYBOOKS_REPO_URL, EXISTING_PLAYBOOKS_DIR, depth=1, single_branch=True, branch=EXISTING_PLAYBOOKS_BRANCH)
+        return None
+    logger.info("Fetching latest existing playbooks.")
+    repo = git.Repo(EXISTING_PLAYBOOKS_DIR)
+    previous_sha = repo.head.commit.hexsha
+    repo.remotes.origin.fetch(EXISTING_PLAYBOOKS_BRANCH, depth=1)
+    repo.git.reset('--hard', f"origin/{EXISTING_PLAYBOOKS_BRANCH}")
+    current_sha = repo.head.commit.hexsha
+    if previous_sha == current_sha:
+        return []
+    try:
+        # Without renames a moved file is listed under both its old and new path
+        return repo.git.diff('--name-only', '--no-renames', previous_sha, current_sha).splitlines()
+    except git.GitCommandError:
+        # The previous commit may no longer be reachable in a shallow checkout
+        return None
+
+async def refresh_existing_playbooks_repo():
+    global existing_playbooks_sha, existing_playbooks_etag
+    have_checkout = os.path.isdir(os.path.join(EXISTING_PLAYBOOKS_DIR, '.git'))
+    headers = {}
+    if have_checkout and existing_playbooks_etag:
+        headers['If-None-Match'] = existing_playbooks_etag
+
+    # The new SHA and ETag are only recorded once the checkout reflects them; saving the ETag
+    # before a failed fetch would turn every later check into a 304 and leave the checkout stale
+    latest_sha = None
+    latest_etag = None
+    unchanged = False
+    try:
+        response = await gh_client.get(EXISTING_PLAYBOOKS_COMMIT_URL, headers=headers)
+        if response.status_code == 304:
+            unchanged = True
+        else:
+            response.raise_for_status()
+            latest_sha = orjson.loads(response.content).get('sha')
+            latest_etag = response.headers.get('ETag')
+    except Exception as err:
+        logger.error(f"Error checking existing playbooks for changes: {err}")
+
+    if have_checkout and (unchanged or latest_sha is None or latest_sha == existing_playbooks_sha):
+        if latest_sha is not None:
+            existing_playbooks_etag = latest_etag
+        if not playbook_cache:
+            await load_existing_playbooks(None)
+        elif set(playbook_cache) - set(playbook_embeddings):
+            await embed_existing_playbooks([])
+        return
+    changed_paths = await asyncio.to_thread(clone_existing_playbooks_repo)
+    # Cached matches may point at playbooks that were just changed or removed
+    clear_cached_playbooks('existing')
+    await load_existing_playbooks(changed_paths if playbook_cache else None)
+    existing_playbooks_sha = latest_sha
+    existing_playbooks_etag = latest_etag
+
+def is_playbook_file(path):
+    return path.endswith(".yml") or path.endswith(".yaml")
+
+def read_playbook(path):
+    with open(path, 'r') as f:
+        return os.path.getmtime(path), f.read()
+
+def list_playbook_files():
+    return [
+        os.path.join(root, file)
+        for root, _, files in os.walk(EXISTING_PLAYBOOKS_DIR)
+        for file in files
+        if is_playbook_file(file)
+    ]
+
+async def load_existing_playbooks(changed_paths):
+    """Refresh playbook_cache, re-reading only changed_paths, or every playbook when None."""
+    global playbook_cache
+    # Incidents keep reading the current cache while this one is built, then it is swapped in
+    new_cache = dict(playbook_cache)
+    if changed_paths is None:
+        paths = await asyncio.to_thread(list_playbook_files)
+        for stale_path in set(new_cache) - set(paths):
+            del new_cache[stale_path]
+        # Skip files whose mtime has not moved since they were cached
+        paths = [
+            path for path in paths
+            if path not in new_cache or new_cache[path][0] != os.path.getmtime(path)
+        ]
+    else:
+        paths = []
+        for changed_path in changed_paths:
+            path = os.path.join(EXISTING_PLAYBOOKS_DIR, changed_path)
+            if not is_playbook_file(path):
+                continue
+            if os.path.isfile(path):
+                paths.append(path)
+            else:
+                new_cache.pop(path, None)
+
+    contents = await asyncio.gather(*(asyncio.to_thread(read_playbook, path) for path in paths))
+    new_cache.update(zip(paths, contents))
+    playbook_cache = new_cache
+    logger.info(f"Loaded {len(paths)} playbook(s); {len(playbook_cache)} cached.")
+    await embed_existing_playbooks(paths)
+
+async def embed_existing_playbooks(paths):
+    global playbook_matrix_paths, playbook_matrix_contents, playbook_matrix
+    for stale_path in set(playbook_embeddings) - set(playbook_cache):
+        del playbook_embeddings[stale_path]
+    for path in paths:
+        playbook_embeddings.pop(path, None)
+
+    # Embed everything still missing, including playbooks whose earlier batch failed, in small
+    # batches of truncated inputs so one bad file cannot fail the rest
+    missing = sorted(set(playbook_cache) - set(playbook_embeddings))
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+        try:
+            response = await openai.Embedding.acreate(
+                model=EMBEDDING_MODEL,
+                input=[playbook_cache[path][1][:EMBEDDING_MAX_CHARS] for path in batch]
+            )
+            for path, item in zip(batch, response['data']):
+                playbook_embeddings[path] = item['embedding']
+        except Exception as err:
+            logger.error(f"Error embedding existing playbooks: {err}")
+
+    # Swap the rows, their contents and the matrix in together so a match never sees a mix
+    paths = list(playbook_embeddings)
+    if not paths:
+        playbook_matrix_paths, playbook_matrix_contents, playbook_matrix = [], [], np.empty((0, 0))
+        return
+    matrix = np.array([playbook_embeddings[path] for path in paths])
+    playbook_matrix_paths = paths
+    playbook_matrix_contents = [playbook_cache[path][1] for path in paths]
+    playbook_matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+def match_playbook_embedding(embedding):
+    """Return the closest existing playbook if it clears the similarity threshold."""
+    if not playbook_matrix_paths:
+        return None
+    query = np.asarray(embedding)
+    scores = playbook_matrix @ (query / np.linalg.norm(query))
+    best = int(np.argmax(scores))
+    if scores[best] < EXISTING_PLAYBOOK_MATCH_THRESHOLD:
+        return None
+    logger.info(f"Existing playbook {playbook_matrix_paths[best]} matched with similarity {scores[best]:.3f}.")
+    return playbook_matrix_contents[best]
+
+async def evaluate_playbook(description, playbook):
+    async with evaluation_semaphore:
+        response = await openai.ChatCompletion.acreate(
             model="gpt-3.5-turbo",
             messages=[
-                {"role": "system", "content": "You are an expert in Ansible playbooks. Evaluate if the provided playbook content matches the given incident description."},
-                {"role": "user", "content": f"Incident description: {description}"},
-                {"role": "assistant", "content": playbook}
-            ]
+                SYSTEM_MSG_EVAL,
+                {"role": "user", "content": f"Playbook:\n{playbook}"},
+                {"role": "user", "content": f"Incident description: {description}"}
+            ],
+            stream=True
         )
-        evaluation = response['choices'][0]['message']['content'].strip()
-        if "matches" in evaluation.lower():
-            return playbook
-
+        # Read the verdict as it streams and stop as soon as it is clear
+        evaluation = ''
+        try:
+            async for chunk in response:
+                # Only rescan the tail that could hold a keyword split across chunks
+                search_from = max(0, len(evaluation) - len("matches") + 1)
+                evaluation += chunk['choices'][0]['delta'].get('content', '')
+                if MATCHES_RE.search(evaluation, search_from):
+                    return playbook
+                if NEGATIVE_VERDICT_RE.match(evaluation):
+                    return None
+        finally:
+            await response.aclose()
     return None
 
-def create_pull_request(branch_name, file_path, playbook_content):
-    repo_url = 'git@github.com:cooktheryan/wranger-out.git'
-    repo_dir = 'repo'
-    pr_url = "https://api.github.com/repos/cooktheryan/wranger-out/pulls"
+async def search_existing_playbooks(description, namespace=''):
+    """Return (playbook, embedding) so the description embedding can be reused by ask_openai."""
+    cached_playbook, embedding = await get_cached_playbook('existing', namespace, description)
+    if cached_playbook:
+        return cached_playbook, embedding
 
+    logger.info("Searching for existing playbooks.")
+    playbook = match_playbook_embedding(embedding)
+    if playbook:
+        store_cached_playbook('existing', namespace, description, embedding, playbook)
+        return playbook, embedding
+
+    # Fall back to asking GPT about every playbook concurrently and stop at the first match
+    existing_playbooks = [content for _, content in playbook_cache.values()]
+    tasks = [asyncio.create_task(evaluate_playbook(description, playbook)) for playbook in existing_playbooks]
     try:
-        # Clone the repository
-        logger.info(f"Cloning repository from {repo_url}")
-        git.Repo.clone_from(repo_url, repo_dir, branch='main')
-        repo = git.Repo(repo_dir)
-
-        # Create a new branch
-        logger.info(f"Creating new branch: {branch_name}")
-        new_branch = repo.create_head(branch_name)
-        new_branch.checkout()
-
-        # Write the formatted playbook content to a file
-        with open(f"{repo_dir}/{file_path}", "w") as file:
-            file.write(playbook_content)
-
-        # Commit and push changes
-        repo.index.add([file_path])
-        repo.index.commit("Add generated playbook")
-        origin = repo.remote(name='origin')
-        origin.push(branch_name)
-
-        # Create a pull request
-        pr_title = "Add generated playbook"
-        pr_body = "This PR contains a generated Ansible playbook."
-        headers = {
-            'Authorization': f'token {github_token}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        payload = {
-            'title': pr_title,
-            'body': pr_body,
-            'head': branch_name,
-            'base': 'main'
-        }
-        logger.info(f"Creating pull request with payload: {payload}")
-        response = requests.post(pr_url, json=payload, headers=headers)
-        logger.info(f"Pull request creation response status code: {response.status_code}")
-        if response.status_code == 201:
-            return response.json()
-        else:
-            logger.error(f"Failed to create pull request: {response.text}")
-            return None
+        for next_result in asyncio.as_completed(tasks):
+            playbook = await next_result
+            if playbook:
+                store_cached_playbook('existing', namespace, description, embedding, playbook)
+                return playbook, embedding
     finally:
-        # Ensure the local repository directory is removed
-        if os.path.isdir(repo_dir):
-            shutil.rmtree(repo_dir)
-
-def update_incident_state(incident_sys_id, state_id, comment=None):
+        for task in tasks:
+            task.cancel()
+
+    return None, embedding
+
+async def create_pull_request(branch_name, file_path, playbook_content):
+    repo_api_url = "/repos/cooktheryan/wranger-out"
+
+    # Look up the tip of main so the new branch can be created from it
+    response = await gh_client.get(f"{repo_api_url}/git/ref/heads/main")
+    if response.status_code != 200:
+        logger.error(f"Failed to look up base branch: {response.text}")
+        return None
+    base_sha = orjson.loads(response.content)['object']['sha']
+
+    # Create a new branch
+    logger.info(f"Creating new branch: {branch_name}")
+    response = await gh_client.post(f"{repo_api_url}/git/refs", content=orjson.dumps({'ref': f"refs/heads/{branch_name}", 'sha': base_sha}))
+    if response.status_code != 201:
+        logger.error(f"Failed to create branch: {response.text}")
+        return None
+
+    # Commit the formatted playbook content straight to the branch
+    content_payload = {
+        'message': "Add generated playbook",
+        'content': base64.b64encode(playbook_content.encode()).decode(),
+        'branch': branch_name
+    }
+    # The file may already exist on main from an earlier merged PR; updating it needs its blob SHA
+    response = await gh_client.get(f"{repo_api_url}/contents/{file_path}", params={'ref': branch_name})
+    if response.status_code == 200:
+        content_payload['sha'] = orjson.loads(response.content)['sha']
+    response = await gh_client.put(f"{repo_api_url}/contents/{file_path}", content=orjson.dumps(content_payload))
+    if response.status_code not in (200, 201):
+        logger.error(f"Failed to commit playbook: {response.text}")
+        await delete_branch(repo_api_url, branch_name)
+        return None
+
+    # Create a pull request
+    pr_title = "Add generated playbook"
+    pr_body = "This PR contains a generated Ansible playbook."
+    payload = {
+        'title': pr_title,
+        'body': pr_body,
+        'head': branch_name,
+        'base': 'main'
+    }
+    logger.info(f"Creating pull request with payload: {payload}")
+    response = await gh_client.post(f"{repo_api_url}/pulls", content=orjson.dumps(payload))
+    logger.info(f"Pull request creation response status code: {response.status_code}")
+    if response.status_code == 201:
+        return orjson.loads(response.content)
+    else:
+        logger.error(f"Failed to create pull request: {response.text}")
+        await delete_branch(repo_api_url, branch_name)
+        return None
+
+async def delete_branch(repo_api_url, branch_name):
+    # Remove a branch left behind by a failed pull request attempt
+    logger.info(f"Deleting branch: {branch_name}")
+    response = await gh_client.delete(f"{repo_api_url}/git/refs/heads/{branch_name}")
+    if response.status_code != 204:
+        logger.error(f"Failed to delete branch {branch_name}: {response.text}")
+
+async def update_incident_state(incident_sys_id, state_id, comment=None):
     update_url = f"{SN_URL}/{incident_sys_id}"
     data = {
         'state': state_id
@@ -164,66 +541,142 @@ def update_incident_state(incident_sys_id, state_id, comment=None):
 
     logger.info(f"Updating incident {incident_sys_id} to state {state_id}.")
     try:
-        response = requests.patch(update_url, json=data, headers=SN_HEADERS, auth=HTTPBasicAuth(sn_username, sn_password))
+        response = await sn_client.patch(update_url, content=orjson.dumps(data))
         logger.info(f"ServiceNow update response status code: {response.status_code}")
         response.raise_for_status()
         logger.info(f"Incident updated successfully.")
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         logger.error(f"HTTP error occurred while updating incident: {http_err}")
     except Exception as err:
         logger.error(f"Other error occurred while updating incident: {err}")
 
-def process_incidents():
-    while True:
-        try:
-            # Get the most recent incident from ServiceNow
-            logger.info("Starting incident processing cycle.")
-            most_recent_incident = get_most_recent_incident()
-            if not most_recent_incident:
-                logger.info("No incidents found.")
-                time.sleep(5)
-                continue
-
-            description = most_recent_incident.get('description')
-            incident_sys_id = most_recent_incident.get('sys_id')
+async def handle_incident(incident):
+    description = incident.get('description')
+    incident_sys_id = incident.get('sys_id')
+    # Cache entries are namespaced per ServiceNow caller
+    caller = incident.get('caller_id') or {}
+    namespace = caller.get('value', '') if isinstance(caller, dict) else caller
 
-            if not description:
-                logger.info("No description found for the incident.")
-                time.sleep(5)
-                continue
+    previous_state = incident.get('state')
+    resolved = False
+    async with incident_semaphore:
+        try:
+            # Mark the incident as being worked on; in_flight_incidents keeps this process from
+            # picking it up twice, and after a restart it is simply retried
+            await update_incident_state(incident_sys_id, IN_PROGRESS_STATE_ID)
 
             # Check if an existing playbook matches the incident description
-            existing_playbook = search_existing_playbooks(description)
+            existing_playbook, embedding = await search_existing_playbooks(description, namespace)
             if existing_playbook:
                 logger.info("Found an existing playbook that matches the incident description.")
-                update_incident_state(incident_sys_id, AWAITING_USER_INFO_STATE_ID, comment=f"Use the following playbook: {EXISTING_PLAYBOOKS_REPO_URL}")
-                continue
+                await update_incident_state(incident_sys_id, AWAITING_USER_INFO_STATE_ID, comment=f"Use the following playbook: {EXISTING_PLAYBOOKS_REPO_URL}")
+                mark_incident_processed(incident_sys_id)
+                resolved = True
+                return
 
             # Get playbook content from OpenAI based on incident description
-            playbook_content = ask_openai(description)
+            playbook_content = await ask_openai(description, namespace, embedding)
 
             # Format the playbook content
             formatted_content = format_playbook_content(playbook_content)
 
-            # Generate branch name
-            branch_name = f"generated-playbook-{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            file_path = "generated_playbook.yml"
+            # Generate branch name and file path; the sys_id keeps concurrently opened PRs from
+            # colliding on the same branch or editing the same file
+            branch_name = f"generated-playbook-{datetime.now().strftime('%Y%m%d%H%M%S')}-{incident_sys_id}"
+            file_path = f"generated_playbook_{incident_sys_id}.yml"
 
             # Create a pull request
-            pr_response = create_pull_request(branch_name, file_path, formatted_content)
+            pr_response = await create_pull_request(branch_name, file_path, formatted_content)
 
             if pr_response:
                 logger.info(f"Pull request created: {pr_response['html_url']}")
                 # Update the incident state to "Awaiting User Info"
-                update_incident_state(incident_sys_id, AWAITING_USER_INFO_STATE_ID)
+                await update_incident_state(incident_sys_id, AWAITING_USER_INFO_STATE_ID)
+                mark_incident_processed(incident_sys_id)
+                resolved = True
             else:
                 logger.error('Failed to create pull request.')
+        except Exception as e:
+            logger.error(f"Error processing incident {incident_sys_id}: {e}")
+        finally:
+            # Hand a failed incident back in its original state so it is retried after a backoff
+            if not resolved:
+                record_incident_failure(incident_sys_id)
+                if previous_state:
+                    await update_incident_state(incident_sys_id, previous_state)
+
+async def track_incident(incident):
+    try:
+        await handle_incident(incident)
+    finally:
+        in_flight_incidents.discard(incident.get('sys_id'))
+
+def schedule_incident(incident):
+    in_flight_incidents.add(incident.get('sys_id'))
+    task = asyncio.create_task(track_incident(incident))
+    # Keep a reference so the task is not garbage collected while it runs
+    incident_tasks.add(task)
+    task.add_done_callback(incident_tasks.discard)
+
+async def process_incidents():
+    interval = POLL_INTERVAL_START
+    while True:
+        try:
+            # Get a batch of unprocessed incidents from ServiceNow while checking, in the
+            # same round trip window, whether the existing playbooks branch has new commits
+            logger.info("Starting incident processing cycle.")
+            recent_incidents, refresh_error = await asyncio.gather(
+                get_recent_incidents(), refresh_existing_playbooks_repo(), return_exceptions=True
+            )
+            # A failed refresh keeps the previous playbooks and must not cost the fetched batch
+            if isinstance(refresh_error, Exception):
+                logger.error(f"Error refreshing existing playbooks: {refresh_error}")
+            if isinstance(recent_incidents, Exception):
+                raise recent_incidents
+            incidents = []
+            now = time.time()
+            for incident in recent_incidents:
+                incident_sys_id = incident.get('sys_id')
+                if incident_sys_id in processed_incidents or incident_sys_id in in_flight_incidents:
+                    continue
+                if incident_sys_id in failed_incidents and failed_incidents[incident_sys_id][1] > now:
+                    continue
+                if not incident.get('description'):
+                    # Nothing to generate from yet; skip it without counting it as a hit, so it is
+                    # picked up once a description is filled in
+                    logger.info(f"No description found for incident {incident_sys_id}.")
+                    continue
+                incidents.append(incident)
+            # Retries of failed incidents do not count as new work for the poll interval
+            if not any(incident.get('sys_id') not in failed_incidents for incident in incidents):
+                if not incidents:
+                    logger.info("No incidents found.")
+                interval = min(POLL_INTERVAL_MAX, interval * 1.5)
+            else:
+                interval = max(POLL_INTERVAL_MIN, interval / 2)
+
+            if incidents:
+                # Handle the batch in the background so polling carries on meanwhile
+                for incident in incidents:
+                    schedule_incident(incident)
 
         except Exception as e:
             logger.error(f"Error processing request: {e}")
 
-        # Sleep for 5 seconds before the next iteration
-        time.sleep(5)
+        # Poll faster while incidents keep arriving and back off while the queue is quiet
+        await asyncio.sleep(interval)
+
+async def main():
+    try:
+        await process_incidents()
+    finally:
+        # Let in-flight incidents hand their state back while the clients are still open
+        for task in incident_tasks:
+            task.cancel()
+        await asyncio.gather(*incident_tasks, return_exceptions=True)
+        await sn_client.aclose()
+        await gh_client.aclose()
+        cache_db.close()
 
 if __name__ == "__main__":
-    process_incidents()
+    asyncio.run(main())